@@ -1,76 +1,148 @@
 import argparse
+import functools
 import re
 import os
-import shutil
-import urllib.parse
-from mutagen.id3 import ID3, TIT2, TALB, TRCK, TRK, TPE1, TPE2, TCON, TCOM, COMM
+import string
+from concurrent.futures import ThreadPoolExecutor
+from mutagen.id3 import ID3, ID3NoHeaderError, TIT2, TALB, TRCK, TPE1, TPE2, TCON, TCOM, COMM, TLEN
 from mutagen.mp3 import MP3
 
+# (path, num, title, artist, dance)
+Track = tuple[str, str, str, str, str]
 
-def create_playlist_files(args: argparse.Namespace):
-    with open('./playlist.m3u', 'w') as playlist_file:
-        lines = ['#EXTM3U\n']
-        sdir = os.listdir(args.dir)
-        sdir.sort()
-        for af in sdir:
-            groups = re.match(r'(\d{2})_(.*);\s(.*)\s--\s(.*)\.mp3', af).groups()
+_FNAME_RE = re.compile(r'(\d{2})_(.*);\s(.*)\s--\s(.*)\.mp3')
 
-            relpath = os.path.join(args.dir, af)
-            audio = MP3(relpath)
-            lines.append(f"#EXTINF:{str(audio.info.length).split('.')[0]},{groups[2]} - {groups[1]}\n")
-            lines.append(urllib.parse.quote(relpath)+'\n')
+# per-file work is mostly disk I/O, so use a few more threads than cores
+_MAX_WORKERS = min(8, (os.cpu_count() or 1) * 2)
 
-        playlist_file.writelines(lines)
-    shutil.copy('./playlist.m3u', './playlist.m3u8')
-    print('Created playlist files')
+# frame class -> apply_tags() argument it is filled from
+_FRAME_BUILDERS = (
+    (TRCK, 'num'),
+    (TIT2, 'title'),
+    (TPE1, 'artist'),
+    (TCOM, 'artist'),
+    (TCON, 'dance'),
+    (COMM, 'dance'),
+    (TALB, 'album'),
+    (TPE2, 'album'),
+    (TLEN, 'length_ms'),
+)
 
+_EXTINF = '#EXTINF:{},{} - {}\n{}\n'.format
 
-def tag(args: argparse.Namespace) -> None:
-    for f in os.listdir(args.dir):
-        matches = re.match(r'(\d{2})_(.*);\s(.*)\s--\s(.*)\.mp3', f)
-        groups = matches.groups()
-        apply_tags(os.path.join(args.dir, f), groups[0], groups[1], groups[2], groups[3], args.name)
+# byte -> percent-encoded text, same safe set as urllib.parse.quote(path)
+_QUOTE_TABLE = [chr(b) if chr(b) in string.ascii_letters + string.digits + '/_.-~' else f'%{b:02X}'
+                for b in range(256)]
 
 
-def apply_tags(f: str, num: str, title: str, artist: str, dance: str, album: str) -> None:
-    tags = ID3(f)
+def _quote(path: str) -> str:
+    return ''.join(map(_QUOTE_TABLE.__getitem__, path.encode('utf-8')))
 
-    tags.delall('COMM')
-    tags.delall('TXXX')
 
-    tags.add(TRCK(encode=3, text=num))
-    tags.add(TRK(encode=3, text=num))
+def _playlist_length(path: str) -> int:
+    # prefer the TLEN frame written by tag() over reading the audio stream
+    try:
+        return int(ID3(path)['TLEN'].text[0]) // 1000
+    except (ID3NoHeaderError, KeyError, ValueError):
+        return int(MP3(path).info.length)
+
+
+def _write_file(name: str, payload: bytes) -> None:
+    fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        view = memoryview(payload)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+
+
+def _playlist_entry(track: Track) -> str:
+    relpath, _, title, artist, _ = track
+    length = _playlist_length(relpath)
+    return _EXTINF(length, artist, title, _quote(relpath))
+
+
+def create_playlist_files(args: argparse.Namespace, tracks: list[Track]):
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as ex:
+        # map() yields in submission order, so the playlist keeps the descriptor order
+        payload = ('#EXTM3U\n' + ''.join(ex.map(_playlist_entry, tracks))).encode('utf-8')
+
+    for name in ('./playlist.m3u', './playlist.m3u8'):
+        _write_file(name, payload)
+    print('Created playlist files')
 
-    tags.add(TIT2(encode=3, text=title))
 
-    tags.add(TPE1(encode=3, text=artist))
-    tags.add(TCOM(encode=3, text=artist))
+def _tag_one(track: Track, album: str) -> str:
+    path, num, title, artist, dance = track
+    # one parse gives both the tags and the length mutagen reports for TLEN
+    audio = MP3(path)
+    if audio.tags is None:
+        audio.add_tags()
+    apply_tags(audio.tags, num, title, artist, dance, album, int(audio.info.length * 1000))
+    audio.save()
+    return path
 
-    tags.add(TCON(encode=3, text=dance))
-    tags.add(COMM(encode=3, text=dance))
 
-    tags.add(TALB(encode=3, text=album))
-    tags.add(TPE2(encode=3, text=album))
-    tags.save()
-    print(f'Tagged {f}')
+def tag(args: argparse.Namespace, tracks: list[Track]) -> None:
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as ex:
+        # report in the main thread; map() yields in submission order and
+        # re-raises exceptions from the workers here
+        for path in ex.map(lambda t: _tag_one(t, args.name), tracks):
+            print(f'Tagged {path}')
 
 
-def rename(args: argparse.Namespace) -> None:
+def apply_tags(tags: ID3, num: str, title: str, artist: str, dance: str, album: str, length_ms: int) -> None:
+    tags.delall('COMM')
+    tags.delall('TXXX')
+
+    values = {'num': num, 'title': title, 'artist': artist, 'dance': dance, 'album': album,
+              'length_ms': str(length_ms)}
+    for cls, field in _FRAME_BUILDERS:
+        frame = cls(encode=3, text=values[field])
+        tags[frame.HashKey] = frame
+
+
+def rename(args: argparse.Namespace) -> list[Track]:
+    # returns the tracks of the descriptor file whose target file exists,
+    # either because it was renamed now or by an earlier run
+    by_prefix = {}
+    names = set()
+    with os.scandir(args.dir) as entries:
+        for entry in entries:
+            names.add(entry.name)
+            prefix, sep, _ = entry.name.partition("-")
+            # only zero-padded ASCII track numbers, so '1-' and '001-' don't count as '01-'
+            if sep and prefix.isascii() and prefix.isdecimal() and prefix == f"{int(prefix):02d}":
+                by_prefix.setdefault(int(prefix), []).append(entry.path)
+
+    tracks = []
     with open(args.file, "r") as file:
         for count, line in enumerate(file, 1):
-            scount = str(count)
-            if len(scount) == 1:
-                scount = "0" + scount
-
-            filep = [f for f in os.listdir(args.dir) if re.match(fr"{scount}-.*", f)]
+            line = line.strip()
+            if not line:
+                continue
+            target = f"{line}.mp3"
+            matches = _FNAME_RE.match(target)
+            if matches is None:
+                print(f'Skipped line {count} of {args.file}: expected "NN_Title; Artist -- Dance"')
+                continue
+
+            targetp = os.path.join(args.dir, target)
+            filep = by_prefix.get(count)
             if filep:
-                filep = os.path.join(args.dir, filep[0])
-                targetp = os.path.join(args.dir, f"{line.strip()}.mp3")
+                filep = filep[0]
                 print(f'Renamed {filep} to {targetp}')
                 os.rename(filep, targetp)
+            elif target not in names:
+                continue
+            tracks.append((targetp, *matches.groups()))
 
+    return tracks
 
-def get_args() -> argparse.Namespace:
+
+@functools.cache
+def _build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(
         prog='AutoDITag',
         description='Automatically rename and tag your dance playlist',
@@ -84,13 +156,18 @@ def get_args() -> argparse.Namespace:
     parser.add_argument('-n', '--name', dest='name', required=True,
                         help='The name of the Playlist. eg: Schulball 08.05.2024')
 
-    return parser.parse_args()
+    return parser
+
+
+def get_args() -> argparse.Namespace:
+    return _build_parser().parse_args()
 
 
 def main():
-    rename(get_args())
-    tag(get_args())
-    create_playlist_files(get_args())
+    args = get_args()
+    tracks = rename(args)
+    tag(args, tracks)
+    create_playlist_files(args, tracks)
 
 
 if __name__ == "__main__":